@@ -204,8 +204,7 @@ class Object(object):
 
     def __setitem__(self, event, value):
         if value is None:
-            if event in self.events:
-                del self.events[event]
+            self.events.pop(event, None)
         else:
             self.events[event] = value
 
@@ -336,18 +335,69 @@ class Profile(Object):
                     del function.calls[callee_id]
 
     def find_cycles(self):
-        """Find cycles using Tarjan's strongly connected components algorithm."""
+        """Find cycles using Gabow's path-based strongly connected components algorithm.
 
-        # Apply the Tarjan's algorithm successively until all functions are visited
-        stack = []
-        data = {}
+        The depth-first search is done iteratively, so that deep call graphs
+        don't exceed Python's recursion limit.
+
+        See also:
+        - https://en.wikipedia.org/wiki/Path-based_strong_component_algorithm
+        """
+
+        preorder = {}
+        assigned = set()
+        S = []
+        P = []
         order = 0
-        for function in self.functions.values():
-            order = self._tarjan(function, order, stack, data)
+        for root in self.functions.values():
+            if root.id in preorder:
+                continue
+            preorder[root.id] = order
+            order += 1
+            S.append(root)
+            P.append(root)
+            stack = [(root, iter(root.calls.values()))]
+            while stack:
+                function, calls = stack[-1]
+                for call in calls:
+                    callee_id = call.callee_id
+                    try:
+                        callee_order = preorder[callee_id]
+                    except KeyError:
+                        callee = self.functions[callee_id]
+                        preorder[callee_id] = order
+                        order += 1
+                        S.append(callee)
+                        P.append(callee)
+                        stack.append((callee, iter(callee.calls.values())))
+                        break
+                    if callee_id not in assigned:
+                        while preorder[P[-1].id] > callee_order:
+                            P.pop()
+                else:
+                    stack.pop()
+                    if P[-1] is function:
+                        # Strongly connected component found
+                        P.pop()
+                        members = []
+                        while True:
+                            member = S.pop()
+                            assigned.add(member.id)
+                            members.append(member)
+                            if member is function:
+                                break
+                        if len(members) > 1:
+                            cycle = Cycle()
+                            for member in members:
+                                cycle.add_function(member)
+
         cycles = []
+        seen = set()
         for function in self.functions.values():
-            if function.cycle is not None and function.cycle not in cycles:
-                cycles.append(function.cycle)
+            cycle = function.cycle
+            if cycle is not None and cycle not in seen:
+                seen.add(cycle)
+                cycles.append(cycle)
         self.cycles = cycles
         if 0:
             for cycle in cycles:
@@ -356,55 +406,40 @@ class Profile(Object):
                     sys.stderr.write("\tFunction %s\n" % member.name)
 
     def prune_root(self, roots, depth=-1):
-        visited = set()
-        frontier = set([(root_node, depth) for root_node in roots])
-        while len(frontier) > 0:
-            node, node_depth = frontier.pop()
-            visited.add(node)
-            if node_depth == 0:
-                continue
-            f = self.functions[node]
-            newNodes = set(f.calls.keys()) - visited
-            frontier = frontier.union({(new_node, node_depth - 1) for new_node in newNodes})
-        subtreeFunctions = {}
-        for n in visited:
-            f = self.functions[n]
-            newCalls = {}
-            for c in f.calls.keys():
-                if c in visited:
-                    newCalls[c] = f.calls[c]
-            f.calls = newCalls
-            subtreeFunctions[n] = f
-        self.functions = subtreeFunctions
+        visited = self._breadth_first(roots, depth, lambda node: self.functions[node].calls.keys())
+        self._prune_unvisited(visited)
 
     def prune_leaf(self, leafs, depth=-1):
-        edgesUp = collections.defaultdict(set)
-        for f in self.functions.keys():
-            for n in self.functions[f].calls.keys():
-                edgesUp[n].add(f)
+        edgesUp = collections.defaultdict(list)
+        for f in self.functions.values():
+            for n in f.calls.keys():
+                edgesUp[n].append(f.id)
         # build the tree up
-        visited = set()
-        frontier = set([(leaf_node, depth) for leaf_node in leafs])
-        while len(frontier) > 0:
-            node, node_depth = frontier.pop()
-            visited.add(node)
+        visited = self._breadth_first(leafs, depth, lambda node: edgesUp[node])
+        self._prune_unvisited(visited)
+
+    def _breadth_first(self, start_nodes, depth, neighbours):
+        """Return the set of nodes reachable from start_nodes within depth steps."""
+
+        visited = set(start_nodes)
+        frontier = collections.deque([(node, depth) for node in visited])
+        while frontier:
+            node, node_depth = frontier.popleft()
             if node_depth == 0:
                 continue
-            newNodes = edgesUp[node] - visited
-            frontier = frontier.union({(new_node, node_depth - 1) for new_node in newNodes})
-        downTree = set(self.functions.keys())
-        upTree = visited
-        path = downTree.intersection(upTree)
-        pathFunctions = {}
-        for n in path:
-            f = self.functions[n]
-            newCalls = {}
-            for c in f.calls.keys():
-                if c in path:
-                    newCalls[c] = f.calls[c]
-            f.calls = newCalls
-            pathFunctions[n] = f
-        self.functions = pathFunctions
+            for new_node in neighbours(node):
+                if new_node not in visited:
+                    visited.add(new_node)
+                    frontier.append((new_node, node_depth - 1))
+        return visited
+
+    def _prune_unvisited(self, visited):
+        functions = {}
+        for n, f in self.functions.items():
+            if n in visited:
+                f.calls = {c: call for c, call in f.calls.items() if c in visited}
+                functions[n] = f
+        self.functions = functions
 
     def getFunctionIds(self, funcName):
         function_names = {v.name: k for (k, v) in self.functions.items()}
@@ -442,93 +477,59 @@ class Profile(Object):
         file.write(v+"\n")
         file.flush()
 
-    class _TarjanData:
-        def __init__(self, order):
-            self.order = order
-            self.lowlink = order
-            self.onstack = False
-
-    def _tarjan(self, function, order, stack, data):
-        """Tarjan's strongly connected components algorithm.
-
-        See also:
-        - http://en.wikipedia.org/wiki/Tarjan's_strongly_connected_components_algorithm
-        """
-
-        try:
-            func_data = data[function.id]
-            return order
-        except KeyError:
-            func_data = self._TarjanData(order)
-            data[function.id] = func_data
-        order += 1
-        pos = len(stack)
-        stack.append(function)
-        func_data.onstack = True
-        for call in function.calls.values():
-            try:
-                callee_data = data[call.callee_id]
-                if callee_data.onstack:
-                    func_data.lowlink = min(func_data.lowlink, callee_data.order)
-            except KeyError:
-                callee = self.functions[call.callee_id]
-                order = self._tarjan(callee, order, stack, data)
-                callee_data = data[call.callee_id]
-                func_data.lowlink = min(func_data.lowlink, callee_data.lowlink)
-        if func_data.lowlink == func_data.order:
-            # Strongly connected component found
-            members = stack[pos:]
-            del stack[pos:]
-            if len(members) > 1:
-                cycle = Cycle()
-                for member in members:
-                    cycle.add_function(member)
-                    data[member.id].onstack = False
-            else:
-                for member in members:
-                    data[member.id].onstack = False
-        return order
-
     def call_ratios(self, event):
+        # Number the cycles, so that membership tests below are integer
+        # compares and the totals can be indexed without hashing objects.
+        cycle_ids = {}
+        for cycle_id, cycle in enumerate(self.cycles):
+            for member in cycle.functions:
+                cycle_ids[member.id] = cycle_id
+
         # Aggregate for incoming calls
-        cycle_totals = {}
-        for cycle in self.cycles:
-            cycle_totals[cycle] = 0.0
+        cycle_totals = [0.0] * len(self.cycles)
         function_totals = {}
+        for function_id in self.functions:
+            function_totals[function_id] = 0.0
+
+        # Gather the edges once, skipping the recursive self calls which
+        # both passes below ignore.  Edges coming into a cycle from outside
+        # are tagged with the callee's cycle id, all others with None.
+        edges = []
         for function in self.functions.values():
-            function_totals[function] = 0.0
+            function_cycle_id = cycle_ids.get(function.id)
+            for call in function.calls.values():
+                assert call.ratio is None
+                if call.callee_id != function.id:
+                    callee_cycle_id = cycle_ids.get(call.callee_id)
+                    if callee_cycle_id == function_cycle_id:
+                        callee_cycle_id = None
+                    edges.append((function, call, callee_cycle_id))
 
         # Pass 1:  function_total gets the sum of call[event] for all
         #          incoming arrows.  Same for cycle_total for all arrows
         #          that are coming into the *cycle* but are not part of it.
-        for function in self.functions.values():
-            for call in function.calls.values():
-                if call.callee_id != function.id:
-                    callee = self.functions[call.callee_id]
-                    if event in call.events:
-                        function_totals[callee] += call[event]
-                        if callee.cycle is not None and callee.cycle is not function.cycle:
-                            cycle_totals[callee.cycle] += call[event]
-                    else:
-                        sys.stderr.write("call_ratios: No data for " + function.name + " call to " + callee.name + "\n")
+        for function, call, callee_cycle_id in edges:
+            if event in call.events:
+                function_totals[call.callee_id] += call[event]
+                if callee_cycle_id is not None:
+                    cycle_totals[callee_cycle_id] += call[event]
+            else:
+                callee = self.functions[call.callee_id]
+                sys.stderr.write("call_ratios: No data for " + function.name + " call to " + callee.name + "\n")
 
         # Pass 2:  Compute the ratios.  Each call[event] is scaled by the
         #          function_total of the callee.  Calls into cycles use the
         #          cycle_total, but not calls within cycles.
-        for function in self.functions.values():
-            for call in function.calls.values():
-                assert call.ratio is None
-                if call.callee_id != function.id:
-                    callee = self.functions[call.callee_id]
-                    if event in call.events:
-                        if callee.cycle is not None and callee.cycle is not function.cycle:
-                            total = cycle_totals[callee.cycle]
-                        else:
-                            total = function_totals[callee]
-                        call.ratio = ratio(call[event], total)
-                    else:
-                        # Warnings here would only repeat those issued above.
-                        call.ratio = 0.0
+        for function, call, callee_cycle_id in edges:
+            if event in call.events:
+                if callee_cycle_id is not None:
+                    total = cycle_totals[callee_cycle_id]
+                else:
+                    total = function_totals[call.callee_id]
+                call.ratio = ratio(call[event], total)
+            else:
+                # Warnings here would only repeat those issued above.
+                call.ratio = 0.0
 
     def integrate(self, outevent, inevent):
         """Propagate function time ratio along the function calls.
@@ -549,13 +550,6 @@ class Profile(Object):
                 if call.callee_id != function.id:
                     assert call.ratio is not None
 
-        # Aggregate the input for each cycle
-        for cycle in self.cycles:
-            total = inevent.null()
-            for function in self.functions.values():
-                total = inevent.aggregate(total, function[inevent])
-            self[inevent] = total
-
         # Integrate along the edges
         total = inevent.null()
         for function in self.functions.values():
@@ -563,6 +557,10 @@ class Profile(Object):
             self._integrate_function(function, outevent, inevent)
         self[outevent] = total
 
+        # Aggregate the input for the cycles
+        if self.cycles:
+            self[inevent] = total
+
     def _integrate_function(self, function, outevent, inevent):
         if function.cycle is not None:
             return self._integrate_cycle(function.cycle, outevent, inevent)
@@ -741,47 +739,48 @@ class Profile(Object):
     def prune(self, node_thres, edge_thres, paths, color_nodes_by_selftime):
         """Prune the profile"""
 
-        # compute the prune ratios
-        for function in self.functions.values():
-            try:
-                function.weight = function[TOTAL_TIME_RATIO]
-            except UndefinedEvent:
-                pass
-
+        # compute the prune ratios, fetching each function's total time
+        # ratio once instead of once per incoming and outgoing call
+        total_time_ratios = {}
+        for function_id, function in self.functions.items():
+            total_time_ratio = function.events.get(TOTAL_TIME_RATIO)
+            if total_time_ratio is not None:
+                function.weight = total_time_ratio
+            total_time_ratios[function_id] = total_time_ratio
+
+        for function_id, function in self.functions.items():
+            function_ratio = total_time_ratios[function_id]
             for call in function.calls.values():
-                callee = self.functions[call.callee_id]
-
-                if TOTAL_TIME_RATIO in call:
+                call_ratio = call.events.get(TOTAL_TIME_RATIO)
+                if call_ratio is not None:
                     # handle exact cases first
-                    call.weight = call[TOTAL_TIME_RATIO]
-                else:
-                    try:
+                    call.weight = call_ratio
+                elif function_ratio is not None:
+                    callee_ratio = total_time_ratios[call.callee_id]
+                    if callee_ratio is not None:
                         # make a safe estimate
-                        call.weight = min(function[TOTAL_TIME_RATIO], callee[TOTAL_TIME_RATIO])
-                    except UndefinedEvent:
-                        pass
+                        call.weight = min(function_ratio, callee_ratio)
 
-        # prune the nodes
-        for function_id in list(self.functions.keys()):
-            function = self.functions[function_id]
-            if function.weight is not None:
-                if function.weight < node_thres:
-                    del self.functions[function_id]
-
-        # prune file paths
-        for function_id in list(self.functions.keys()):
-            function = self.functions[function_id]
-            if paths and function.filename and not any(function.filename.startswith(path) for path in paths):
-                del self.functions[function_id]
-            elif paths and function.module and not any((function.module.find(path)>-1) for path in paths):
-                del self.functions[function_id]
+        # prune the nodes and file paths, building the surviving functions
+        # dict in one go rather than deleting entries as we go
+        functions = {}
+        for function_id, function in self.functions.items():
+            if function.weight is not None and function.weight < node_thres:
+                continue
+            if paths:
+                if function.filename and not any(function.filename.startswith(path) for path in paths):
+                    continue
+                elif function.module and not any((function.module.find(path)>-1) for path in paths):
+                    continue
+            functions[function_id] = function
+        self.functions = functions
 
         # prune the edges
-        for function in self.functions.values():
-            for callee_id in list(function.calls.keys()):
-                call = function.calls[callee_id]
-                if callee_id not in self.functions or call.weight is not None and call.weight < edge_thres:
-                    del function.calls[callee_id]
+        for function in functions.values():
+            function.calls = {
+                callee_id: call for callee_id, call in function.calls.items()
+                if callee_id in functions and not (call.weight is not None and call.weight < edge_thres)
+            }
 
         if color_nodes_by_selftime:
             weights = []
@@ -824,27 +823,21 @@ class Profile(Object):
 
 
 class Struct:
-    """Masquerade a dictionary with a structure-like behavior."""
-
-    def __init__(self, attrs = None):
-        if attrs is None:
-            attrs = {}
-        self.__dict__['_attrs'] = attrs
+    """Masquerade a dictionary with a structure-like behavior.
 
-    def __getattr__(self, name):
-        try:
-            return self._attrs[name]
-        except KeyError:
-            raise AttributeError(name)
+    The dictionary items become plain instance attributes, so that reading
+    and writing them doesn't go through __getattr__/__setattr__.
+    """
 
-    def __setattr__(self, name, value):
-        self._attrs[name] = value
+    def __init__(self, attrs = None):
+        if attrs is not None:
+            self.__dict__.update(attrs)
 
     def __str__(self):
-        return str(self._attrs)
+        return str(self.__dict__)
 
     def __repr__(self):
-        return repr(self._attrs)
+        return repr(self.__dict__)
 
 
 class ParseError(Exception):
@@ -2754,43 +2747,40 @@ class PstatsParser:
         return function
 
     def parse(self):
-        self.profile[TIME] = 0.0
-        self.profile[TOTAL_TIME] = self.stats.total_tt
+        total_time = 0.0
+        max_total_time = self.stats.total_tt
         for fn, (cc, nc, tt, ct, callers) in self.stats.stats.items():
             callee = self.get_function(fn)
             callee.called = nc
             callee[TOTAL_TIME] = ct
             callee[TIME] = tt
-            self.profile[TIME] += tt
-            self.profile[TOTAL_TIME] = max(self.profile[TOTAL_TIME], ct)
+            total_time += tt
+            max_total_time = max(max_total_time, ct)
             for fn, value in callers.items():
                 caller = self.get_function(fn)
-                call = Call(callee.id)
                 if isinstance(value, tuple):
+                    # Accumulate the (nc, cc, tt, ct) tuples before creating the call
+                    call_calls = 0
+                    call_total_time = 0
                     for i in range(0, len(value), 4):
-                        nc, cc, tt, ct = value[i:i+4]
-                        if CALLS in call:
-                            call[CALLS] += cc
-                        else:
-                            call[CALLS] = cc
-
-                        if TOTAL_TIME in call:
-                            call[TOTAL_TIME] += ct
-                        else:
-                            call[TOTAL_TIME] = ct
-
+                        call_calls += value[i + 1]
+                        call_total_time += value[i + 3]
                 else:
-                    call[CALLS] = value
-                    call[TOTAL_TIME] = ratio(value, nc)*ct
-
+                    call_calls = value
+                    call_total_time = ratio(value, nc)*ct
+                call = Call(callee.id)
+                call[CALLS] = call_calls
+                call[TOTAL_TIME] = call_total_time
                 caller.add_call(call)
+        self.profile[TIME] = total_time
+        self.profile[TOTAL_TIME] = max_total_time
 
         if False:
             self.stats.print_stats()
             self.stats.print_callees()
 
-        # Compute derived events
-        self.profile.validate()
+        # Compute derived events.  No need to validate the edges, as every
+        # caller and callee was created through get_function above.
         self.profile.ratio(TIME_RATIO, TIME)
         self.profile.ratio(TOTAL_TIME_RATIO, TOTAL_TIME)
 
@@ -3139,9 +3129,12 @@ class Theme:
             l = lmin + weight*(lmax - lmin)
         else:
             base = self.skew
-            h = hmin + ((hmax-hmin)*(-1.0 + (base ** weight)) / (base - 1.0))
-            s = smin + ((smax-smin)*(-1.0 + (base ** weight)) / (base - 1.0))
-            l = lmin + ((lmax-lmin)*(-1.0 + (base ** weight)) / (base - 1.0))
+            # Same ramp for all three components, so only evaluate it once
+            numerator = -1.0 + (base ** weight)
+            denominator = base - 1.0
+            h = hmin + ((hmax-hmin)*numerator / denominator)
+            s = smin + ((smax-smin)*numerator / denominator)
+            l = lmin + ((lmax-lmin)*numerator / denominator)
 
         return self.hsl_to_rgb(h, s, l)
 
@@ -3161,18 +3154,22 @@ class Theme:
         else:
             m2 = l + s - l*s
         m1 = l*2.0 - m2
-        r = self._hue_to_rgb(m1, m2, h + 1.0/3.0)
-        g = self._hue_to_rgb(m1, m2, h)
-        b = self._hue_to_rgb(m1, m2, h - 1.0/3.0)
-
-        # Apply gamma correction
-        r **= self.gamma
-        g **= self.gamma
-        b **= self.gamma
+        hue_to_rgb = self._hue_to_rgb
+        r = hue_to_rgb(m1, m2, h + 1.0/3.0)
+        g = hue_to_rgb(m1, m2, h)
+        b = hue_to_rgb(m1, m2, h - 1.0/3.0)
+
+        # Apply gamma correction (a no-op for the default color theme)
+        gamma = self.gamma
+        if gamma != 1.0:
+            r **= gamma
+            g **= gamma
+            b **= gamma
 
         return (r, g, b)
 
-    def _hue_to_rgb(self, m1, m2, h):
+    @staticmethod
+    def _hue_to_rgb(m1, m2, h):
         if h < 0.0:
             h += 1.0
         elif h > 1.0:
@@ -3235,11 +3232,8 @@ themes = {
 
 def sorted_iteritems(d):
     # Used mostly for result reproducibility (while testing.)
-    keys = list(d.keys())
-    keys.sort()
-    for key in keys:
-        value = d[key]
-        yield key, value
+    for key in sorted(d):
+        yield key, d[key]
 
 
 class DotWriter:
@@ -3253,8 +3247,21 @@ class DotWriter:
     strip = False
     wrap = False
 
+    # Number of characters to accumulate before writing to fp
+    buffer_size = 65536
+
+    # Templates for the nodes and edges of graph(), filled with already
+    # quoted DOT IDs
+    node_template = '\t%s [%s, label=%s%s];\n'
+    edge_template = '\t%s -> %s [%s, label=%s, %s];\n'
+
     def __init__(self, fp):
         self.fp = fp
+        self._buffer = []
+        self._buffered = 0
+        self._attr_fields = {}
+        self._id_cache = {}
+        self._wrapper = textwrap.TextWrapper(break_long_words=False)
 
     def wrap_function_name(self, name):
         """Split the function name on multiple lines."""
@@ -3264,7 +3271,9 @@ class DotWriter:
             height = max(int(len(name)/(1.0 - ratio) + 0.5), 1)
             width = max(len(name)/height, 32)
             # TODO: break lines in symbols
-            name = textwrap.fill(name, width, break_long_words=False)
+            wrapper = self._wrapper
+            wrapper.width = width
+            name = wrapper.fill(name)
 
         # Take away spaces
         name = name.replace(", ", ",")
@@ -3290,6 +3299,10 @@ class DotWriter:
         self.attr('edge', fontname=fontname)
 
         functions2 = {function.name: function for _, function in sorted_iteritems(profile2.functions)}
+        functions_by_id1 = {function.id: function for _, function in sorted_iteritems(profile1.functions)}
+
+        # Computed lazily, as it needs at least one function common to both profiles
+        min_diff = max_diff = None
 
         for _, function1 in sorted_iteritems(profile1.functions):
             labels = []
@@ -3299,7 +3312,7 @@ class DotWriter:
                 function2 = functions2[name]
                 if self.wrap:
                     name = self.wrap_function_name(name)
-                if color_by_difference:
+                if color_by_difference and min_diff is None:
                     min_diff, max_diff = min_max_difference(profile1, profile2)
                 labels.append(name)
                 weight_difference = 0
@@ -3359,8 +3372,6 @@ class DotWriter:
                     function_name = function1.stripped_name()
                 else:
                     function_name = function1.name
-                if color_by_difference:
-                    min_diff, max_diff = 0, 0
 
                 # dot can't parse quoted strings longer than YY_BUF_SIZE, which
                 # defaults to 16K. But some annotated C++ functions (e.g., boost,
@@ -3392,18 +3403,18 @@ class DotWriter:
 
             label = '\n'.join(labels)
 
+            color, fontcolor, _ = self._node_style(theme, weight)
             self.node(function1.id,
                       label=label,
                       orientation=orientation,
-                      color=self.color(theme.node_bgcolor(weight)),
+                      color=color,
                       shape=shape,
-                      fontcolor=self.color(theme.node_fgcolor(weight)),
+                      fontcolor=fontcolor,
                       fontsize="%f" % theme.node_fontsize(weight),
                       tooltip=function1.filename,
                       )
 
             calls2 = {call.callee_id: call for _, call in sorted_iteritems(function2.calls)}
-            functions_by_id1 = {function.id: function for _, function in sorted_iteritems(profile1.functions)}
 
             for _, call1 in sorted_iteritems(function1.calls):
                 labels = []
@@ -3425,14 +3436,15 @@ class DotWriter:
 
                 weight = 0 if color_by_difference else call1.weight
                 label = '\n'.join(labels)
+                color, fontsize, penwidth, arrowsize = self._edge_style(theme, weight)
                 self.edge(function1.id, call1.callee_id,
                           label=label,
-                          color=self.color(theme.edge_color(weight)),
-                          fontcolor=self.color(theme.edge_color(weight)),
-                          fontsize="%.2f" % theme.edge_fontsize(weight),
-                          penwidth="%.2f" % theme.edge_penwidth(weight),
-                          labeldistance="%.2f" % theme.edge_penwidth(weight),
-                          arrowsize="%.2f" % theme.edge_arrowsize(weight),
+                          color=color,
+                          fontcolor=color,
+                          fontsize=fontsize,
+                          penwidth=penwidth,
+                          labeldistance=penwidth,
+                          arrowsize=arrowsize,
                           )
         self.end_graph()
 
@@ -3447,6 +3459,14 @@ class DotWriter:
         self.attr('node', fontname=fontname, shape="box", style=nodestyle, fontcolor=fontcolor, width=0, height=0)
         self.attr('edge', fontname=fontname)
 
+        show_function_events = self.show_function_events
+        show_edge_events = self.show_edge_events
+        write = self.write
+        node_id = self.node_id
+        id = self.id
+        node_template = self.node_template
+        edge_template = self.edge_template
+
         for _, function in sorted_iteritems(profile.functions):
             labels = []
             if function.process is not None:
@@ -3471,12 +3491,10 @@ class DotWriter:
                 function_name = self.wrap_function_name(function_name)
             labels.append(function_name)
 
-            for event in self.show_function_events:
-                if event in function.events:
-                    label = event.format(function[event])
-                    labels.append(label)
+            events = function.events
+            labels += [event.format(events[event]) for event in show_function_events if event in events]
             if function.called is not None:
-                labels.append("%u%s" % (function.called, MULTIPLICATION_SIGN))
+                labels.append(times(function.called))
 
             if function.weight is not None:
                 weight = function.weight
@@ -3484,45 +3502,93 @@ class DotWriter:
                 weight = 0.0
 
             label = '\n'.join(labels)
-            self.node(function.id,
-                label = label,
-                color = self.color(theme.node_bgcolor(weight)),
-                fontcolor = self.color(theme.node_fgcolor(weight)),
-                fontsize = "%.2f" % theme.node_fontsize(weight),
-                tooltip = function.filename,
-            )
+            if function.filename is not None:
+                tooltip = ', tooltip=' + id(function.filename)
+            else:
+                tooltip = ''
+            write(node_template % (node_id(function.id), self._node_attrs(theme, weight), id(label), tooltip))
 
             for _, call in sorted_iteritems(function.calls):
-                callee = profile.functions[call.callee_id]
-
-                labels = []
-                for event in self.show_edge_events:
-                    if event in call.events:
-                        label = event.format(call[event])
-                        labels.append(label)
+                events = call.events
+                labels = [event.format(events[event]) for event in show_edge_events if event in events]
 
                 if call.weight is not None:
                     weight = call.weight
-                elif callee.weight is not None:
-                    weight = callee.weight
                 else:
-                    weight = 0.0
+                    callee = profile.functions[call.callee_id]
+                    if callee.weight is not None:
+                        weight = callee.weight
+                    else:
+                        weight = 0.0
 
                 label = '\n'.join(labels)
 
-                self.edge(function.id, call.callee_id,
-                    label = label,
-                    color = self.color(theme.edge_color(weight)),
-                    fontcolor = self.color(theme.edge_color(weight)),
-                    fontsize = "%.2f" % theme.edge_fontsize(weight),
-                    penwidth = "%.2f" % theme.edge_penwidth(weight),
-                    labeldistance = "%.2f" % theme.edge_penwidth(weight),
-                    arrowsize = "%.2f" % theme.edge_arrowsize(weight),
-                )
+                head, tail = self._edge_attrs(theme, weight)
+                write(edge_template % (node_id(function.id), node_id(call.callee_id), head, id(label), tail))
 
         self.end_graph()
 
+    def _node_style(self, theme, weight):
+        """Return the node (color, fontcolor, fontsize) attributes, memoized by weight."""
+
+        try:
+            return self._node_style_cache[weight]
+        except KeyError:
+            style = (self.color(theme.node_bgcolor(weight)),
+                     self.color(theme.node_fgcolor(weight)),
+                     "%.2f" % theme.node_fontsize(weight))
+            self._node_style_cache[weight] = style
+            return style
+
+    def _edge_style(self, theme, weight):
+        """Return the edge (color, fontsize, penwidth, arrowsize) attributes, memoized by weight."""
+
+        try:
+            return self._edge_style_cache[weight]
+        except KeyError:
+            style = (self.color(theme.edge_color(weight)),
+                     "%.2f" % theme.edge_fontsize(weight),
+                     "%.2f" % theme.edge_penwidth(weight),
+                     "%.2f" % theme.edge_arrowsize(weight))
+            self._edge_style_cache[weight] = style
+            return style
+
+    # _node_attrs() and _edge_attrs() render the weight dependent attributes
+    # of graph() straight into DOT, so that emitting each node and edge is a
+    # mere template substitution.  The attributes are sorted by name, with
+    # the label (and tooltip) going in between.
+
+    def _node_attrs(self, theme, weight):
+        try:
+            return self._node_attrs_cache[weight]
+        except KeyError:
+            id = self.id
+            color, fontcolor, fontsize = self._node_style(theme, weight)
+            attrs = 'color=' + id(color) + ', fontcolor=' + id(fontcolor) + ', fontsize=' + id(fontsize)
+            self._node_attrs_cache[weight] = attrs
+            return attrs
+
+    def _edge_attrs(self, theme, weight):
+        try:
+            return self._edge_attrs_cache[weight]
+        except KeyError:
+            id = self.id
+            color, fontsize, penwidth, arrowsize = self._edge_style(theme, weight)
+            color = id(color)
+            penwidth = id(penwidth)
+            attrs = ('arrowsize=' + id(arrowsize) + ', color=' + color + ', fontcolor=' + color + ', fontsize=' + id(fontsize),
+                     'labeldistance=' + penwidth + ', penwidth=' + penwidth)
+            self._edge_attrs_cache[weight] = attrs
+            return attrs
+
     def begin_graph(self):
+        # Few distinct weights are shared by many nodes and edges, so cache
+        # the formatted colors and sizes for each graph
+        self._node_style_cache = {}
+        self._edge_style_cache = {}
+        self._node_attrs_cache = {}
+        self._edge_attrs_cache = {}
+
         self.write('digraph {\n')
         # Work-around graphviz bug[1]: unnamed graphs have "%3" tooltip in SVG
         # output. The bug was fixed upstream, but graphviz shipped in recent
@@ -3532,45 +3598,41 @@ class DotWriter:
 
     def end_graph(self):
         self.write('}\n')
+        self.flush()
 
     def attr(self, what, **attrs):
-        self.write("\t")
-        self.write(what)
-        self.attr_list(attrs)
-        self.write(";\n")
+        self.write("\t" + what + self.attr_list(attrs) + ";\n")
 
     def node(self, node, **attrs):
-        self.write("\t")
-        self.node_id(node)
-        self.attr_list(attrs)
-        self.write(";\n")
+        self.write("\t" + self.node_id(node) + self.attr_list(attrs) + ";\n")
 
     def edge(self, src, dst, **attrs):
-        self.write("\t")
-        self.node_id(src)
-        self.write(" -> ")
-        self.node_id(dst)
-        self.attr_list(attrs)
-        self.write(";\n")
+        self.write("\t" + self.node_id(src) + " -> " + self.node_id(dst) + self.attr_list(attrs) + ";\n")
 
     def attr_list(self, attrs):
+        """Return the DOT attribute list for attrs, skipping None values."""
+
         if not attrs:
-            return
-        self.write(' [')
-        first = True
-        for name, value in sorted_iteritems(attrs):
-            if value is None:
-                continue
-            if first:
-                first = False
-            else:
-                self.write(", ")
-            assert isinstance(name, str)
-            assert name.isidentifier()
-            self.write(name)
-            self.write('=')
-            self.id(value)
-        self.write(']')
+            return ''
+        # The same few attribute sets are used over and over, so validate
+        # and sort their names, and prepare the "name=" prefixes, only once
+        # per set
+        keys = tuple(attrs)
+        try:
+            fields = self._attr_fields[keys]
+        except KeyError:
+            for name in keys:
+                assert isinstance(name, str)
+                assert name.isidentifier()
+            fields = [(name, name + '=') for name in sorted(keys)]
+            self._attr_fields[keys] = fields
+        id = self.id
+        items = []
+        for name, prefix in fields:
+            value = attrs[name]
+            if value is not None:
+                items.append(prefix + id(value))
+        return ' [' + ', '.join(items) + ']'
 
     def node_id(self, id):
         # Node IDs need to be unique (can't be truncated) but dot doesn't allow
@@ -3579,41 +3641,68 @@ class DotWriter:
         # https://github.com/jrfonseca/gprof2dot/issues/99
         if isinstance(id, str) and len(id) > 1024:
             id = '_' + hashlib.sha1(id.encode('utf-8'), usedforsecurity=False).hexdigest()
-        self.id(id)
+        return self.id(id)
 
     def id(self, id):
-        if isinstance(id, (int, float)):
-            s = str(id)
-        elif isinstance(id, str):
-            if id.isalnum() and not id.startswith('0x'):
+        """Return id as a DOT ID, quoting it if necessary."""
+
+        # Attribute values are mostly strings, so test for those first
+        if isinstance(id, str):
+            # Short strings, like colors and sizes, are used over and over,
+            # so remember how they were quoted
+            cacheable = len(id) <= 32
+            if cacheable:
+                try:
+                    return self._id_cache[id]
+                except KeyError:
+                    pass
+            # Leave only plain ASCII identifiers unquoted, as long as they are
+            # not DOT keywords
+            if id.isascii() and id.isidentifier() and id.lower() not in self._keywords:
                 s = id
             else:
                 s = self.escape(id)
+            if cacheable:
+                self._id_cache[id] = s
+            return s
+        elif isinstance(id, (int, float)):
+            return str(id)
         else:
             raise TypeError
-        self.write(s)
 
-    def color(self, rgb):
-        r, g, b = rgb
+    # DOT keywords, which are case-independent
+    _keywords = frozenset(['node', 'edge', 'graph', 'digraph', 'subgraph', 'strict'])
 
-        def float2int(f):
-            if f <= 0.0:
-                return 0
-            if f >= 1.0:
-                return 255
-            return int(255.0*f + 0.5)
+    _hex = tuple("%02x" % i for i in range(256))
 
-        return "#" + "".join(["%02x" % float2int(c) for c in (r, g, b)])
+    def color(self, rgb):
+        r, g, b = rgb
+        digits = self._hex
+        return ("#" +
+                digits[0 if r <= 0.0 else 255 if r >= 1.0 else int(255.0*r + 0.5)] +
+                digits[0 if g <= 0.0 else 255 if g >= 1.0 else int(255.0*g + 0.5)] +
+                digits[0 if b <= 0.0 else 255 if b >= 1.0 else int(255.0*b + 0.5)])
+
+    _escape_table = str.maketrans({
+        '\\': r'\\',
+        '\n': r'\n',
+        '\t': r'\t',
+        '"': r'\"',
+    })
 
     def escape(self, s):
-        s = s.replace('\\', r'\\')
-        s = s.replace('\n', r'\n')
-        s = s.replace('\t', r'\t')
-        s = s.replace('"', r'\"')
-        return '"' + s + '"'
+        return '"' + s.translate(self._escape_table) + '"'
 
     def write(self, s):
-        self.fp.write(s)
+        self._buffer.append(s)
+        self._buffered += len(s)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.fp.write(''.join(self._buffer))
+        self._buffer.clear()
+        self._buffered = 0
 
 
 
@@ -17,10 +17,20 @@
 #
 
 
+import concurrent.futures
+import contextlib
 import difflib
+import filecmp
+import functools
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
 import optparse
 import os.path
 import sys
+import traceback
 import subprocess
 from   subprocess import PIPE
 import shutil
@@ -51,56 +61,270 @@ formats_compare = [
 ]
 
 
-NB_RUN_FAILURES = 0
-NB_DIFF_FAILURES = 0
+class Result:
+    """Output and failure counts of a test.
+
+    Tests run concurrently, so their output is collected here and only
+    written out, in order, once they are done.
+    """
+
+    def __init__(self):
+        self.output = []
+        self.run_failures = 0
+        self.diff_failures = 0
+        # Base path of the graph generated by the test, to be checked
+        self.graph = None
+        # Whether the graph needs to be rendered
+        self.stale = False
+        # Digest of the inputs of the graph, for the cache
+        self.key = None
+
+    def write(self, text):
+        self.output.append(text)
+
+
+def run(result, cmd, stderr=None):
+    result.write(' '.join(cmd) + '\n')
+    # Capture the output, so that it goes along with the rest of the test's
+    p = subprocess.run(cmd, stdout=PIPE, stderr=PIPE if stderr is None else stderr)
+    result.write(p.stdout.decode('UTF-8', 'replace'))
+    if p.stderr:
+        result.write(p.stderr.decode('UTF-8', 'replace'))
+    retcde = p.returncode
+    if retcde !=0:
+        result.write("Run failed and returned %d\n" % retcde)
+        result.run_failures += 1
+    return retcde
 
 
-def run(cmd, stderr=None):
-    global NB_RUN_FAILURES
-    retcde = 0
-    sys.stdout.write(' '.join(cmd) + '\n')
-    sys.stdout.flush()
-    p = subprocess.Popen(cmd, stderr=stderr)
-    try:
-        retcde = p.wait()
-        if retcde !=0:
-            print("Run failed and returned %d" % retcde)
-            sys.stdout.flush()
-            NB_RUN_FAILURES += 1
-    except KeyboardInterrupt:
-        p.terminate()
-        raise
-    return retcde
+# Pool of processes running gprof2dot in-process, or None to spawn a new
+# interpreter for every run
+gprof2dot_pool = None
+
+gprof2dot_module = None
+
+def gprof2dot_main(path, args):
+    """Run gprof2dot's main() within a worker process of gprof2dot_pool,
+    returning its exit code and what it wrote to stderr."""
 
+    global gprof2dot_module
+    if gprof2dot_module is None:
+        spec = importlib.util.spec_from_file_location('gprof2dot', path)
+        gprof2dot_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(gprof2dot_module)
 
-coverage_append = False
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        try:
+            gprof2dot_module.main(args)
+        except SystemExit as ex:
+            if ex.code is None or isinstance(ex.code, int):
+                retcde = ex.code or 0
+            else:
+                sys.stderr.write('%s\n' % ex.code)
+                retcde = 1
+        except Exception:
+            traceback.print_exc()
+            retcde = 1
+        else:
+            retcde = 0
+    return retcde, stderr.getvalue()
+
+
+def run_gprof2dot(result, args, stderr=None):
+    global gprof2dot_pool
+    pool = gprof2dot_pool
+    if pool is not None and stderr is None:
+        result.write(' '.join([options.gprof2dot] + args) + '\n')
+        try:
+            retcde, output = pool.submit(gprof2dot_main, options.gprof2dot, args).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died abruptly, failing every run pending on the pool,
+            # not just its own, so retry this run in a new interpreter, as
+            # all remaining ones will be
+            gprof2dot_pool = None
+            result.write('gprof2dot worker process died, retrying in a new interpreter\n')
+        else:
+            result.write(output)
+            if retcde !=0:
+                result.write("Run failed and returned %d\n" % retcde)
+                result.run_failures += 1
+            return retcde
 
-def run_gprof2dot(args, stderr=None):
-    global coverage_append
     cmd = [options.python]
     if options.coverage:
-        cmd += ['-m', 'coverage', 'run']
-        if coverage_append:
-            cmd += ['-a']
-        else:
-            coverage_append = True
-        cmd += ['--']
+        # Each run writes its own data file, to be combined at the end,
+        # rather than all appending to (and re-reading) the same one
+        cmd += ['-m', 'coverage', 'run', '--parallel-mode', '--']
     cmd += [options.gprof2dot]
     cmd += args
-    return run(cmd, stderr=stderr)
+    return run(result, cmd, stderr=stderr)
+
 
+def read_lines(filename):
+    # Read and decode the whole file at once, then split it into lines with
+    # the same newline translation as text mode
+    with open(filename, 'rb', buffering=1 << 20) as fp:
+        data = fp.read()
+    return io.StringIO(data.decode('UTF-8'), newline=None).readlines()
 
-def diff(a, b):
-    global NB_DIFF_FAILURES
-    a_lines = open(a, 'rt', encoding='UTF-8').readlines()
-    b_lines = open(b, 'rt', encoding='UTF-8').readlines()
-    diff_lines = difflib.unified_diff(a_lines, b_lines, fromfile=a, tofile=b)
 
-    diff_txt = ''.join(diff_lines)
+def diff(result, a, b):
+    # Most files are identical, so only compute a diff when they are not
+    if filecmp.cmp(a, b, shallow=False):
+        return
+
+    # Prefer git's diff, which is much faster than difflib on large files
+    try:
+        p = subprocess.run(['git', 'diff', '--no-index', '--no-color', '--no-ext-diff', '--ignore-cr-at-eol',
+                            '--', a, b],
+                           stdout=PIPE, stderr=PIPE)
+    except OSError:
+        p = None
+    if p is not None and p.returncode in (0, 1):
+        diff_txt = p.stdout.decode('UTF-8', 'replace')
+    else:
+        a_lines = read_lines(a)
+        b_lines = read_lines(b)
+        diff_lines = difflib.unified_diff(a_lines, b_lines, fromfile=a, tofile=b)
+
+        diff_txt = ''.join(diff_lines)
     if len(diff_txt) > 0:
-        NB_DIFF_FAILURES += 1
-        sys.stdout.write("Non empty diff for files %s and %s" %(a,b))
-    sys.stdout.write(diff_txt)
+        result.diff_failures += 1
+        result.write("Non empty diff for files %s and %s" %(a,b))
+    result.write(diff_txt)
+
+
+# Maps the generated .dot files to the digest of the inputs they were
+# generated from, so that they are only regenerated when gprof2dot.py, the
+# python interpreter or the profiles change
+cache = {}
+
+
+def cache_key(args, profiles):
+    h = hashlib.sha1(setup_digest.encode())
+    h.update('\0'.join(args).encode())
+    for profile in profiles:
+        with open(profile, 'rb') as fp:
+            h.update(hashlib.sha1(fp.read()).digest())
+    return h.hexdigest()
+
+
+def generate(result, args, profiles, base):
+    """Generate a graph, unless it is up to date."""
+
+    dot = base + '.dot'
+
+    # Coverage needs gprof2dot to actually run
+    if not options.coverage:
+        result.key = cache_key(args, profiles)
+        if (not options.force and cache.get(dot) == result.key
+                and os.path.exists(dot) and os.path.exists(base + '.png')):
+            result.write('%s is up to date\n' % dot)
+            result.graph = base
+            return
+        cache.pop(dot, None)
+
+    if run_gprof2dot(result, args + profiles + ['-o', dot]) != 0:
+        return
+
+    result.graph = base
+    result.stale = True
+
+
+def render(results):
+    """Render the graphs of several tests with a single dot process."""
+
+    batch = Result()
+    dots = [result.graph + '.dot' for result in results]
+    if run(batch, ['dot', '-Tpng', '-O'] + dots) == 0:
+        for result in results:
+            os.replace(result.graph + '.dot.png', result.graph + '.png')
+        return batch
+
+    # Render the graphs one by one, to tell which ones fail, discarding
+    # those the batch got to render before failing
+    batch.run_failures = 0
+    batch.write('Rendering graphs separately\n')
+    for result in results:
+        try:
+            os.remove(result.graph + '.dot.png')
+        except FileNotFoundError:
+            pass
+        if run(result, ['dot', '-Tpng', '-o', result.graph + '.png', result.graph + '.dot']) != 0:
+            result.graph = None
+    return batch
+
+
+def check(result):
+    """Compare a rendered graph against the reference."""
+
+    base = result.graph
+    dot = base + '.dot'
+
+    ref_dot = base + '.orig.dot'
+    ref_png = base + '.orig.png'
+
+    if result.key is not None:
+        cache[dot] = result.key
+
+    if options.force or not os.path.exists(ref_dot):
+        shutil.copy(dot, ref_dot)
+        shutil.copy(base + '.png', ref_png)
+    else:
+        diff(result, ref_dot, dot)
+
+
+def test_profile(format, entry):
+    result = Result()
+    result.write(entry.name + '\n')
+
+    profile = entry.path
+    base = profile[:-len(format) - 1]
+    generate(result, ['-f', format], [profile], base)
+    return result
+
+
+def test_compare(format_compare, entry):
+    result = Result()
+    ext = 'txt' if format_compare == 'axe' else format_compare
+    base1 = os.path.join(entry.path, entry.name + '1.')
+    base2 = os.path.join(entry.path, entry.name + '2.')
+
+    result.write(entry.name + '1.' + ext + '\n')
+
+    generate(result, ['-f', format_compare, '--compare'], [base1 + ext, base2 + ext], base1)
+    return result
+
+
+def test_prune(test_dir, flag, function, name):
+    # test the -z/--root and -l/--leaf flags, limited by --depth, on a graph
+    # where functions within the depth are reached both by a short and a long
+    # path (a->b->c->d->e and a->x->d->e), so that only pruning by shortest
+    # distance keeps them all
+    result = Result()
+    result.write('depth.json %s %s --depth=3\n' % (flag, function))
+
+    base = os.path.join(test_dir, 'prune', 'depth')
+    generate(result, ['-f', 'json', flag, function, '--depth=3'], [base + '.json'], base + '.' + name)
+    return result
+
+
+def test_list_functions(test_dir):
+    # test the --list-functions flag only for pstats format
+    # (redirecting stderr to a file always spawns a new interpreter, as
+    # Profile.printFunctionIds() binds sys.stderr when gprof2dot is imported)
+    result = Result()
+    profile = os.path.join(test_dir, 'pstats', 'memtrail.pstats')
+    genfileNm = os.path.join(test_dir, 'pstats', 'function-list.testgen.txt')
+    outfile = open(genfileNm, "w")
+    for flagVal in ("+", "execfile", "*execfile", "*:execfile", "*parse", "*parse_*"):
+        run_gprof2dot(result, ['-f', "pstats", "--list-functions="+flagVal, profile], stderr=outfile)
+
+    outfile.close()
+
+    diff(result, genfileNm, os.path.join(test_dir, 'pstats', 'function-list.orig.txt'))
+    return result
 
 
 def main():
@@ -108,7 +332,7 @@ def main():
 
     global options
     global formats
-    global NB_RUN_FAILURES, NB_DIFF_FAILURES
+    global setup_digest
 
     test_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -132,6 +356,15 @@ def main():
         action="store_true",
         dest="coverage", default=False,
         help="code coverage")
+    optparser.add_option(
+        '--isolate',
+        action="store_true",
+        dest="isolate", default=False,
+        help="run gprof2dot in a new interpreter for every test")
+    optparser.add_option(
+        '-j', '--jobs', metavar='N',
+        type="int", dest="jobs", default=os.cpu_count() or 1,
+        help="number of tests to run in parallel [default: %default]")
 
     # Added this to avoid failing the test when a (hopefully small) number of formats
     # result in error. This allows some flexibility in CI testing.
@@ -143,88 +376,115 @@ def main():
 
     (options, args) = optparser.parse_args(sys.argv[1:])
 
+    if options.jobs < 1:
+        optparser.error('invalid number of jobs %d' % options.jobs)
+
     if len(args):
         formats = args
 
-    for format in formats:
-        test_subdir = os.path.join(test_dir, format)
-        for filename in os.listdir(test_subdir):
-            name, ext = os.path.splitext(filename)
-            if ext == '.' + format:
-                sys.stdout.write(filename + '\n')
-
-                profile = os.path.join(test_subdir, filename)
-                dot = os.path.join(test_subdir, name + '.dot')
-                png = os.path.join(test_subdir, name + '.png')
-
-                ref_dot = os.path.join(test_subdir, name + '.orig.dot')
-                ref_png = os.path.join(test_subdir, name + '.orig.png')
+    h = hashlib.sha1()
+    with open(options.gprof2dot, 'rb') as fp:
+        h.update(fp.read())
+    python = shutil.which(options.python) or options.python
+    h.update(os.path.realpath(python).encode())
+    try:
+        h.update(subprocess.run([python, '-c', 'import sys; print(sys.version)'], stdout=PIPE).stdout)
+    except OSError:
+        pass
+    setup_digest = h.hexdigest()
 
-                if run_gprof2dot(['-f', format, '-o', dot, profile]) != 0:
-                    continue
+    cache_filename = os.path.join(test_dir, '.test_cache.json')
+    try:
+        with open(cache_filename, 'rt') as fp:
+            cache.update(json.load(fp))
+    except (OSError, ValueError):
+        pass
 
-                if run(['dot', '-Tpng', '-o', png, dot]) != 0:
-                    continue
+    tests = []
 
-                if options.force or not os.path.exists(ref_dot):
-                    shutil.copy(dot, ref_dot)
-                    shutil.copy(png, ref_png)
-                else:
-                    diff(ref_dot, dot)
+    for format in formats:
+        suffix = '.' + format
+        with os.scandir(os.path.join(test_dir, format)) as it:
+            for entry in it:
+                if entry.name.endswith(suffix):
+                    tests.append(functools.partial(test_profile, format, entry))
 
     for format_compare in formats_compare:
-        subdir = os.path.join(test_dir, 'compare', format_compare)
-        for dirname in os.listdir(subdir):
-            test_subdir = os.path.join(subdir, dirname)
-            name1 = dirname + '1.'
-            name2 = dirname + '2.'
-            filename1 = name1 + 'txt' if format_compare == 'axe' else name1 + format_compare
-            filename2 = name2 + 'txt' if format_compare == 'axe' else name2 + format_compare
+        with os.scandir(os.path.join(test_dir, 'compare', format_compare)) as it:
+            for entry in it:
+                tests.append(functools.partial(test_compare, format_compare, entry))
 
-            sys.stdout.write(filename1 + '\n')
+    tests.append(functools.partial(test_prune, test_dir, '-z', 'a', 'root'))
+    tests.append(functools.partial(test_prune, test_dir, '-l', 'e', 'leaf'))
+    tests.append(functools.partial(test_list_functions, test_dir))
 
-            profile1 = os.path.join(test_subdir, filename1)
-            profile2 = os.path.join(test_subdir, filename2)
-            dot = os.path.join(test_subdir, name1 + '.dot')
-            png = os.path.join(test_subdir, name1 + '.png')
+    nb_run_failures = 0
+    nb_diff_failures = 0
 
-            ref_dot = os.path.join(test_subdir, name1 + '.orig.dot')
-            ref_png = os.path.join(test_subdir, name1 + '.orig.png')
+    def report(result):
+        nonlocal nb_run_failures, nb_diff_failures
+        sys.stdout.write(''.join(result.output))
+        sys.stdout.flush()
+        nb_run_failures += result.run_failures
+        nb_diff_failures += result.diff_failures
 
-            if run_gprof2dot(['-f', format_compare, '-o', dot, '--compare', profile1, profile2]) != 0:
-                continue
-
-            if run(['dot', '-Tpng', '-o', png, dot]) != 0:
-                continue
-
-            if options.force or not os.path.exists(ref_dot):
-                shutil.copy(dot, ref_dot)
-                shutil.copy(png, ref_png)
-            else:
-                diff(ref_dot, dot)
-
-    # test the --list-functions flag only for pstats format
-    profile = os.path.join(test_dir, 'pstats', 'memtrail.pstats')
-    genfileNm = os.path.join(test_dir, 'pstats', 'function-list.testgen.txt')
-    outfile = open(genfileNm, "w")
-    for flagVal in ("+", "execfile", "*execfile", "*:execfile", "*parse", "*parse_*"):
-        run_gprof2dot(['-f', "pstats", "--list-functions="+flagVal, profile], stderr=outfile)
-
-    outfile.close()
-
-    diff(genfileNm, os.path.join(test_dir, 'pstats', 'function-list.orig.txt'))
+    if options.coverage:
+        result = Result()
+        run(result, [options.python, '-m', 'coverage', 'erase'])
+        report(result)
+
+    # Avoid paying for the interpreter startup and gprof2dot.py compilation on
+    # every run, by reusing a few worker processes, unless gprof2dot needs to
+    # run in a different interpreter or under coverage.  Workers are spawned,
+    # as forking a process that is already running threads is not safe.
+    global gprof2dot_pool
+    try:
+        same_python = os.path.samefile(python, sys.executable)
+    except OSError:
+        same_python = False
+    if not options.isolate and not options.coverage and same_python:
+        gprof2dot_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=options.jobs, mp_context=multiprocessing.get_context('spawn'))
+    pool = gprof2dot_pool
+
+    # The tests spend their time waiting on gprof2dot and dot subprocesses, so
+    # threads suffice to keep all cores busy
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        results = list(executor.map(lambda test: test(), tests))
+
+    if pool is not None:
+        pool.shutdown()
+
+    # Render the graphs in batches, one dot process per job, as dot takes
+    # longer to start than to render most of them
+    stale = [result for result in results if result.stale]
+    batches = [stale[i::options.jobs] for i in range(options.jobs)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        for batch in executor.map(render, [batch for batch in batches if batch]):
+            report(batch)
+
+    for result in results:
+        if result.graph is not None:
+            check(result)
+        report(result)
+
+    with open(cache_filename, 'wt') as fp:
+        json.dump(cache, fp, indent=1, sort_keys=True)
 
     if options.coverage:
+        result = Result()
+        run(result, [options.python, '-m', 'coverage', 'combine'])
         if os.environ.get('GITHUB_ACTIONS', 'false') == 'true':
-            run([options.python, '-m', 'coverage', 'xml'])
+            run(result, [options.python, '-m', 'coverage', 'xml'])
         else:
-            run([options.python, '-m', 'coverage', 'html'])
+            run(result, [options.python, '-m', 'coverage', 'html'])
+        report(result)
 
-    if NB_RUN_FAILURES or NB_DIFF_FAILURES:
-        print("Nb runs ending in error: %d" % NB_RUN_FAILURES)
-        print("Nb diffs showing a difference: %d" % NB_DIFF_FAILURES)
+    if nb_run_failures or nb_diff_failures:
+        print("Nb runs ending in error: %d" % nb_run_failures)
+        print("Nb diffs showing a difference: %d" % nb_diff_failures)
         if (options.max_acceptable is not None
-             and NB_RUN_FAILURES + NB_DIFF_FAILURES > options.max_acceptable ):
+             and nb_run_failures + nb_diff_failures > options.max_acceptable ):
             print("Too many errors: returning non-zero code")
             sys.exit(1)
 